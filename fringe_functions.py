@@ -1,10 +1,53 @@
 import numpy as np
 import matplotlib.pyplot as plt
+from numba import njit, vectorize
 
 """
 Bunch of functions for simulating a fringe packet and group delay calculations
 """
 
+#Random number generator for all the simulated noise (reseed with
+#ff.rng = np.random.default_rng(seed) for reproducible runs)
+rng = np.random.default_rng()
+
+@vectorize(cache=True)
+def sinc_poly(z):
+    """
+    Fast approximation of np.sinc (sin(pi*z)/(pi*z)). Uses a polynomial in z^2
+    (fit on |z| <= 1, error < 1e-9) instead of calling sin, and falls back
+    to the exact expression outside of that.
+
+    Inputs:
+        z = argument of the sinc
+    Outputs:
+        sinc(z)
+
+    """
+
+    if abs(z) > 1:
+        return np.sin(np.pi*z)/(np.pi*z)
+
+    z2 = z*z
+    return 0.9999999992570514 + z2*(-1.644933993832625 + z2*(0.811741252607089
+           + z2*(-0.19074475068166014 + z2*(0.026127476632384353
+           + z2*(-0.002315804930480789 + z2*0.00012582167762649734)))))
+
+
+def abs2(z):
+    """
+    Calculate |z|^2 of a complex number/array, without the square root
+    (and squaring) that np.abs(z)**2 would do
+
+    Inputs:
+        z = complex number or array
+    Outputs:
+        |z|^2
+
+    """
+
+    return z.real*z.real + z.imag*z.imag
+
+
 def fringe_flux(x,lam,bandpass,F_0,vis,coh_phase,disp_phase=0,offset=0):
     """
     Calculate the flux of a polychromatic fringe pattern
@@ -30,7 +73,7 @@ def fringe_flux(x,lam,bandpass,F_0,vis,coh_phase,disp_phase=0,offset=0):
 
     """
 
-    envelope = np.sinc(x*bandpass/lam**2) #Calculate polychromatic envelope
+    envelope = sinc_poly(x*bandpass/lam**2) #Calculate polychromatic envelope
     i = F_0*(1 + envelope*vis*np.cos(2*np.pi*x/lam - coh_phase
                                      - disp_phase - offset))
 
@@ -40,60 +83,70 @@ def fringe_flux(x,lam,bandpass,F_0,vis,coh_phase,disp_phase=0,offset=0):
 ################### Refractive Index and Dispersion Functions #################
 
 
-def sellmeier_equation(lam):
+#Sellmeier coefficients of BK7 glass (C values squared, as that's all that's used)
+B1 = 1.03961212
+B2 = 0.231792344
+B3 = 1.01046945
+C1sq = 6.00069867e-3**2
+C2sq = 2.00179144e-2**2
+C3sq = 103.560653**2
+
+
+def sellmeier_and_group(lam):
     """
-    Calculate the refractive index of BK7 glass at a given wavelength
+    Calculate both the refractive index and group index of BK7 glass at a
+    given wavelength, sharing the Sellmeier terms between the two
 
     Inputs:
         lam = wavelength
     Outputs:
         refractive index n
+        group refractive index n_group
 
     """
 
-    B1 = 1.03961212
-    B2 = 0.231792344
-    B3 = 1.01046945
-    C1 = 6.00069867e-3
-    C2 = 2.00179144e-2
-    C3 = 103.560653
+    lam2 = lam*lam
+    D1 = C1sq - lam2
+    D2 = C2sq - lam2
+    D3 = C3sq - lam2
+    t1 = B1/D1
+    t2 = B2/D2
+    t3 = B3/D3
 
-    n2 = 1 + B1*lam**2/(C1**2-lam**2) + \
-             B2*lam**2/(C2**2-lam**2) + \
-             B3*lam**2/(C3**2-lam**2)
+    n = np.sqrt(1 + lam2*(t1+t2+t3))
 
-    return np.sqrt(n2)
+    #Derivative of the Sellmeier terms: B*lam^2/D^2 + B/D = B*C^2/D^2
+    adjustment_factor = lam2*(t1*C1sq/D1 + t2*C2sq/D2 + t3*C3sq/D3)/n
 
+    return n, n - adjustment_factor
 
-def calc_group_index(lam):
+
+def sellmeier_equation(lam):
     """
-    Calculate the group index of BK7 glass at a given wavelength
+    Calculate the refractive index of BK7 glass at a given wavelength
 
     Inputs:
         lam = wavelength
     Outputs:
-        group refractive index n_group
+        refractive index n
 
     """
 
-    B1 = 1.03961212
-    B2 = 0.231792344
-    B3 = 1.01046945
-    C1 = 6.00069867e-3
-    C2 = 2.00179144e-2
-    C3 = 103.560653
-    n = sellmeier_equation(lam)
+    return sellmeier_and_group(lam)[0]
 
-    a1 = B1*lam**2/(C1**2-lam**2)**2
-    a2 = B1/(C1**2-lam**2)
-    a3 = B2*lam**2/(C2**2-lam**2)**2
-    a4 = B2/(C2**2-lam**2)
-    a5 = B3*lam**2/(C3**2-lam**2)**2
-    a6 = B3/(C3**2-lam**2)
 
-    adjustment_factor = lam**2*(a1+a2+a3+a4+a5+a6)/n
+def calc_group_index(lam):
+    """
+    Calculate the group index of BK7 glass at a given wavelength
 
-    return n - adjustment_factor
+    Inputs:
+        lam = wavelength
+    Outputs:
+        group refractive index n_group
+
+    """
+
+    return sellmeier_and_group(lam)[1]
 
 
 def phaseshift_glass(lam,length,lam_0):
@@ -110,8 +163,8 @@ def phaseshift_glass(lam,length,lam_0):
 
     """
 
-    n = sellmeier_equation(lam)
-    n_grp = calc_group_index(lam_0)
+    n = sellmeier_and_group(lam)[0]
+    n_grp = sellmeier_and_group(lam_0)[1]
     OPD = (n-n_grp)*length
 
     phase_shift = OPD*2*np.pi/lam
@@ -139,23 +192,47 @@ def cal_coherence(delay_bad,delay_fix,wavelengths,bandpass,true_params):
 
     """
 
+    return cal_coherence_batch(np.array([delay_bad]),delay_fix,wavelengths,
+                               bandpass,true_params)[0]
+
+
+def cal_coherence_batch(delays_bad,delay_fix,wavelengths,bandpass,true_params):
+    """
+    Calculates the complex coherence from a simulated tricoupler for a batch
+    of independent frames at once
+
+    Inputs:
+        delays_bad = list of delays caused by the atmosphere, one per frame
+        delay_fix = delay caused by the delay line
+                    (effective delay is delay_bad - delay_fix)
+        wavelengths = wavelength channels to use
+        bandpass = wavelength channel width
+        true_params = "fake" true parameters of the source as a tuple of:
+                      (Flux (reduced by throughput), Visibility, Phase of coherence (with turbulence))
+    Outputs:
+        Complex coherence with shape (number of frames, number of wavelengths)
+
+    """
+
     F_0,vis,coh_phase = true_params
 
-    eff_delay = delay_bad - delay_fix #Calculate effective delay
+    #Calculate effective delay of each frame, as a column
+    eff_delay = (np.asarray(delays_bad) - delay_fix)[:,np.newaxis]
 
-    fluxes = np.zeros((3,len(wavelengths)))
-    i = 0
-    for output_offset in 2*np.pi/3*np.array([0,1,2]):
-        #Calculate intensity output of each fiber (each output has an offset)
-        flux = fringe_flux(eff_delay,wavelengths,bandpass,F_0,vis,
-                           coh_phase,offset=output_offset)
-        #Make it noisy based on shot noise and read noise
-        shot_noise = np.random.poisson(flux)
-        fluxes[i] = np.round(shot_noise + np.random.normal(scale=1.6))
-        i += 1
+    #Calculate intensity output of each fiber (each output has an offset),
+    #with shape (3,number of frames,number of wavelengths)
+    output_offsets = 2*np.pi/3*np.array([0,1,2])[:,np.newaxis,np.newaxis]
+    flux = fringe_flux(eff_delay,wavelengths,bandpass,F_0,vis,
+                       coh_phase,offset=output_offsets)
+    #Make it noisy based on read noise and shot noise (rounded in place)
+    fluxes = rng.normal(scale=1.6,size=flux.shape)
+    fluxes += rng.poisson(flux)
+    np.rint(fluxes,out=fluxes)
 
-    #Combine the outputs into the coherence
-    gamma = (3*fluxes[0] + np.sqrt(3)*1j*(fluxes[2]-fluxes[1]))/np.sum(fluxes,axis=0)-1
+    #Combine the outputs into the coherence (each output is a contiguous
+    #(frames,wavelengths) block of fluxes)
+    flux0,flux1,flux2 = fluxes
+    gamma = (3*flux0 + np.sqrt(3)*1j*(flux2-flux1))/(flux0+flux1+flux2)-1
 
     return gamma
 
@@ -165,6 +242,9 @@ def find_white_fringe(gamma,delay,wavelengths):
     Given a complex coherence and a trial delay, find the "white_fringe" of that
     delay
 
+    LEGACY: only handles a single trial delay. Use group_delay_envelope (or
+    step_frame in a fringe tracking loop) to do all trial delays at once.
+
     Inputs:
         gamma = Complex coherence
         delay = trial delay
@@ -176,7 +256,26 @@ def find_white_fringe(gamma,delay,wavelengths):
     #Rotate in the trial delay phasors
     phasors = gamma*np.exp(1j*2*np.pi/wavelengths*delay)
 
-    return np.abs(np.sum(phasors))**2 #Sum them up and take the intensity
+    return abs2(np.sum(phasors)) #Sum them up and take the intensity
+
+
+def trial_phasors(trial_delays,wavelengths,dtype=complex):
+    """
+    Calculate the phasors used to rotate the coherence by each trial delay.
+    These only depend on the trial delays and wavelengths, so can be
+    calculated once and reused for every frame.
+
+    Inputs:
+        trial_delays = list of trial delays
+        wavelengths = list of wavelength channels
+        dtype = complex type of the phasors (np.complex64 halves the memory
+                used, which is plenty of precision to find the envelope peak)
+    Outputs:
+        Array of phasors with shape (number of trial delays, number of wavelengths)
+
+    """
+
+    return np.exp(1j*2*np.pi*np.outer(trial_delays,1/wavelengths)).astype(dtype)
 
 
 def group_delay_envelope(gamma,trial_delays,wavelengths,plot=False):
@@ -195,22 +294,76 @@ def group_delay_envelope(gamma,trial_delays,wavelengths,plot=False):
 
     """
 
-    F_array = []
-    for delay in trial_delays:
-        #Find the white light intensity of a given trial delay
-        F = find_white_fringe(gamma,delay,wavelengths)
-        F_array.append(F)
+    #Rotate in the phasors of every trial delay and sum over wavelength
+    #(a single matrix-vector product)
+    F_array = abs2(trial_phasors(trial_delays,wavelengths) @ gamma)
+
     if plot:
         plt.plot(trial_delays,F_array) #Plot it
         plt.show()
 
-    return np.array(F_array)
+    return F_array
+
+
+def group_delay_envelope_fft(gamma,wavelengths,delay_step,num_delays,
+                             n_fft=2**14,plot=False):
+    """
+    Given a complex coherence, calculate the group delay envelope on a regular
+    grid of trial delays with an FFT. The wavelength channels are snapped onto
+    a regular wavenumber grid of spacing 1/(n_fft*delay_step), so a larger
+    n_fft gives a smaller snapping error.
+
+    Only worth using for large trial delay grids (many thousands of delays):
+    for a few hundred delays group_delay_envelope is faster, and it is exact
+    rather than limited by the snapping error (~0.2% of the peak at
+    n_fft=2**14).
+
+    Inputs:
+        gamma = Complex coherence
+        wavelengths = list of wavelength channels
+        delay_step = spacing of the trial delays (must be smaller than
+                     1/(wavenumber range of the channels))
+        num_delays = number of trial delays around zero delay to return
+        n_fft = length of the FFT
+        plot = Whether to plot the white light fringe intensity against the
+               trial delays.
+    Output:
+        List of trial delays
+        List of white light fringe intensities for each trial delay
+
+    """
+
+    #Place each coherence on the closest bin of the wavenumber grid
+    wavenumbers = 1/wavelengths
+    d_wavenumber = 1/(n_fft*delay_step)
+    bins = np.round((wavenumbers - wavenumbers.min())/d_wavenumber).astype(int)
+    gamma_grid = np.zeros(n_fft,dtype=complex)
+    np.add.at(gamma_grid,bins,gamma)
+
+    #Inverse FFT rotates in the phasors of every multiple of delay_step at once
+    F_full = abs2(n_fft*np.fft.ifft(gamma_grid))
+
+    #Only keep the trial delays around zero, in increasing order
+    steps = np.fft.fftshift(np.fft.fftfreq(n_fft,1/n_fft))
+    F_full = np.fft.fftshift(F_full)
+    keep = np.abs(steps) < num_delays/2
+    trial_delays = steps[keep]*delay_step
+    F_array = F_full[keep]
+
+    if plot:
+        plt.plot(trial_delays,F_array) #Plot it
+        plt.show()
+
+    return trial_delays, F_array
 
 
 def find_delay(delay_envelope,trial_delays):
     """
     Given a group delay envelope, find an estimate of the group delay
 
+    LEGACY: kept for the single-shot scripts. In a fringe tracking loop,
+    step_frame finds the maximum while it calculates the envelope.
+
     Inputs:
         delay_envelope = List of white light fringe intensities for each trial delay
         trial_delays = list of trial delays
@@ -223,10 +376,85 @@ def find_delay(delay_envelope,trial_delays):
     return trial_delays[np.argmax(delay_envelope)]
 
 
+@njit(fastmath=True,cache=True)
+def step_frame(delay_bad,delay_fix,wavelengths,bandpass,trial_delays,phasors,
+               a,true_params,ave_envelope,gamma,rng):
+    """
+    Perform one frame of fringe tracking: simulate the noisy tricoupler
+    outputs, combine them into the complex coherence, add the group delay
+    envelope to the running average and find the group delay.
+
+    Equivalent to cal_coherence + group_delay_envelope + find_delay, fused
+    into a single compiled loop so no temporary arrays are made each frame.
+
+    Inputs:
+        delay_bad = delay caused by the atmosphere (want to remove)
+        delay_fix = delay caused by the delay line
+                    (effective delay is delay_bad - delay_fix)
+        wavelengths = wavelength channels to use
+        bandpass = wavelength channel width
+        trial_delays = list of trial delays
+        phasors = phasors of each trial delay and wavelength (see trial_phasors)
+        a = scale factor for the group delay envelope averaging
+        true_params = "fake" true parameters of the source as a tuple of:
+                      (Flux (reduced by throughput), Visibility, Phase of coherence (with turbulence))
+        ave_envelope = running average of the group delay envelope
+                       (updated in place)
+        gamma = buffer for the complex coherence of each wavelength
+                (overwritten in place). The envelope is accumulated in the
+                precision of this buffer (e.g. np.complex64 for single)
+        rng = random number generator for the noise (normally ff.rng)
+    Output:
+        Estimation of the group delay from the averaged envelope
+
+    """
+
+    F_0,vis,coh_phase = true_params
+
+    eff_delay = delay_bad - delay_fix #Calculate effective delay
+
+    for k in range(len(wavelengths)):
+        lam = wavelengths[k]
+
+        #Polychromatic envelope
+        envelope = sinc_poly(eff_delay*bandpass/lam**2)
+
+        #Intensity of each fiber, made noisy with shot noise and read noise.
+        #The offset outputs use cos(phase - offset) expanded in terms of the
+        #sin and cos of the same phase (which compile to one sincos call)
+        phase = 2*np.pi*eff_delay/lam - coh_phase
+        c = envelope*vis*np.cos(phase)
+        s = envelope*vis*np.sin(phase)
+        flux0 = F_0*(1 + c)
+        flux1 = F_0*(1 - 0.5*c + 0.5*np.sqrt(3)*s)
+        flux2 = F_0*(1 - 0.5*c - 0.5*np.sqrt(3)*s)
+        flux0 = np.round(rng.poisson(flux0) + rng.normal(0,1.6))
+        flux1 = np.round(rng.poisson(flux1) + rng.normal(0,1.6))
+        flux2 = np.round(rng.poisson(flux2) + rng.normal(0,1.6))
+
+        #Combine the outputs into the coherence
+        gamma[k] = (3*flux0 + np.sqrt(3)*1j*(flux2-flux1))/(flux0+flux1+flux2) - 1
+
+    #Rotate in the trial delay phasors, sum them and add the white light
+    #intensity to the running average, keeping track of the maximum
+    zero = gamma.dtype.type(0) #Zero in the precision of gamma
+    i_max = 0
+    for d in range(len(trial_delays)):
+        acc = zero
+        for k in range(len(wavelengths)):
+            acc += gamma[k]*phasors[d,k]
+        F = acc.real**2 + acc.imag**2
+        ave_envelope[d] = a*F + (1-a)*ave_envelope[d]
+        if ave_envelope[d] > ave_envelope[i_max]:
+            i_max = d
+
+    return trial_delays[i_max]
+
+
 ########################## AC Functions #######################################
 
 
-def cal_AC_output(delay_bad,delay_fix,wavelengths,bandpass,length,lam_0,true_params):
+def cal_AC_output(delay_bad,delay_fix,wavelengths,bandpass,disp_phase,true_params):
     """
     Calculates the flux output from a simulated AC coupler
 
@@ -236,8 +464,8 @@ def cal_AC_output(delay_bad,delay_fix,wavelengths,bandpass,length,lam_0,true_par
                     (effective delay is delay_bad - delay_fix)
         wavelengths = wavelength channels to use
         bandpass = wavelength channel width
-        length = Length of extra glass for dispersion
-        lam_0 = Central wavelength for dispersion
+        disp_phase = phase shift due to glass dispersion for each wavelength
+                     (see phaseshift_glass)
         true_params = "fake" true parameters of the source as a tuple of:
               (Flux (reduced by throughput), Visibility, Phase of coherence (with turbulence))
     Outputs:
@@ -249,21 +477,20 @@ def cal_AC_output(delay_bad,delay_fix,wavelengths,bandpass,length,lam_0,true_par
 
     eff_delay = delay_bad - delay_fix #Calculate effective delay
 
-    fluxes = np.zeros((2,len(wavelengths)))
-    i = 0
-    for output_offset in np.pi*np.array([0,1]):
-        #Calculate intensity output of each fiber (each output has an offset)
-        flux = fringe_flux(eff_delay,wavelengths,bandpass,F_0,vis,
-                           coh_phase,phaseshift_glass(wavelengths,length,lam_0),offset=output_offset)
-        #Make it noisy based on shot noise and read noise
-        shot_noise = np.random.poisson(flux)
-        fluxes[i] = np.round(shot_noise + np.random.normal(scale=1.6))
-        i += 1
+    #Calculate intensity output of each fiber (each output has an offset),
+    #with shape (2,number of wavelengths)
+    output_offsets = np.pi*np.array([[0],[1]])
+    flux = fringe_flux(eff_delay,wavelengths,bandpass,F_0,vis,
+                       coh_phase,disp_phase,offset=output_offsets)
+    #Make it noisy based on read noise and shot noise (rounded in place)
+    fluxes = rng.normal(scale=1.6,size=flux.shape)
+    fluxes += rng.poisson(flux)
+    np.rint(fluxes,out=fluxes)
 
     return fluxes
 
 
-def calc_chi_2_AC(gamma_r,delay,wavelengths,length,lam_0):
+def calc_chi_2_AC(gamma_r,delay,wavelengths,disp_phase):
     """
     Given the real part of the coherence and a trial delay, calculate the chi^2 value
 
@@ -271,19 +498,19 @@ def calc_chi_2_AC(gamma_r,delay,wavelengths,length,lam_0):
         gamma_r = Real part of the Complex coherence
         delay = trial delay
         wavelengths = list of wavelength channels
-        length = length of the glass extension
-        lam_0 = central wavelength for dispersion
+        disp_phase = phase shift due to glass dispersion for each wavelength
+                     (see phaseshift_glass)
     Outputs:
         Chi^2
     """
 
     #Calculate each element of the chi^2
-    chi_lam = (np.cos(2*np.pi*delay/wavelengths - phaseshift_glass(wavelengths,length,lam_0)) - gamma_r)**2
+    chi_lam = (np.cos(2*np.pi*delay/wavelengths - disp_phase) - gamma_r)**2
 
     return np.sum(chi_lam) #Sum them up
 
 
-def find_delay_AC(gamma_r,trial_delays,wavelengths,length,lam_0,plot=False):
+def find_delay_AC(gamma_r,trial_delays,wavelengths,disp_phase,plot=False):
     """
     Given the real part of the coherence and a list of trial delays, find an estimate
     of the group delay through chi^2 minimization
@@ -292,8 +519,8 @@ def find_delay_AC(gamma_r,trial_delays,wavelengths,length,lam_0,plot=False):
         gamma = Complex coherence
         trial_delays = list of trial delays
         wavelengths = list of wavelength channels
-        length = length of the glass extension
-        lam_0 = central wavelength for dispersion
+        disp_phase = phase shift due to glass dispersion for each wavelength
+                     (see phaseshift_glass)
         plot = Whether to plot the white light fringe intensity against the
                trial delays.
     Output:
@@ -301,27 +528,13 @@ def find_delay_AC(gamma_r,trial_delays,wavelengths,length,lam_0,plot=False):
 
     """
 
-    chi_2_min = 1e10
+    #Calculate the chi^2 of every trial delay at once (shape Ndelay x Nlam)
+    arg = 2*np.pi*np.outer(trial_delays,1/wavelengths) - disp_phase
+    chi_2_array = np.sum((np.cos(arg) - gamma_r)**2,axis=1)
+
     if plot:
-        chi_2_plot_array = []
-        for delay in trial_delays:
-            #Find the white light intensity of a given trial delay
-            chi_2 = calc_chi_2_AC(gamma_r,delay,wavelengths,length,lam_0)
-            chi_2_plot_array.append(chi_2)
-            #Is the intensity bigger than any trial delay that's come before?
-            if chi_2 < chi_2_min:
-                chi_2_min = chi_2
-                delay_min = delay
-        plt.plot(trial_delays,chi_2_plot_array) #Plot it
+        plt.plot(trial_delays,chi_2_array) #Plot it
         plt.show()
 
-    else:
-        for delay in trial_delays:
-            #Find the white light intensity of a given trial delay
-            chi_2 = calc_chi_2_AC(gamma_r,delay,wavelengths,length,lam_0)
-            #Is the intensity bigger than any trial delay that's come before?
-            if chi_2 < chi_2_min:
-                chi_2_min = chi_2
-                delay_min = delay
-
-    return delay_min
+    #Trial delay with the smallest chi^2
+    return trial_delays[np.argmin(chi_2_array)]
@@ -11,7 +11,8 @@ applies the delay correction, and then calculates the estimated visibility^2
 bandpass = 15e-9
 start_wavelength = 600e-9
 end_wavelength = 750e-9
-wavelengths = np.arange(start_wavelength,end_wavelength,bandpass)[:-1] + 0.5*bandpass
+num_channels = int(round((end_wavelength-start_wavelength)/bandpass))
+wavelengths = np.linspace(start_wavelength+0.5*bandpass,end_wavelength-0.5*bandpass,num_channels)
 
 #Throughput (tricoupler with instrumental throughput eta)
 eta = 0.5
@@ -48,20 +49,22 @@ true_params = (F_0,vis,coh_phase)
 #Dispersion parameters
 lam_0 = 675e-9
 length = 5e-2 #Length of extended bit of glass
+#Dispersional phase shift of the glass (doesn't change, so only calculate once)
+disp_phase = ff.phaseshift_glass(wavelengths,length,lam_0)
 
 #Delay to try and recover (pretend it's caused by the atmosphere)
 bad_delay = 1.62e-5
 
 
 #Find real part of the complex coherence
-fluxes = ff.cal_AC_output(bad_delay,0,wavelengths,bandpass,length,lam_0,true_params)
+fluxes = ff.cal_AC_output(bad_delay,0,wavelengths,bandpass,disp_phase,true_params)
 gamma_r = (fluxes[1] - fluxes[0])/(fluxes[0]+fluxes[1])
 
 #List of trial delays to scan
 trial_delays = np.linspace(-5e-5,5e-5,50000)
 
 #Estimate the delay through phasor rotation (and plot it)
-fix_delay = ff.find_delay_AC(gamma_r,trial_delays,wavelengths,length,lam_0,plot=True)
+fix_delay = ff.find_delay_AC(gamma_r,trial_delays,wavelengths,disp_phase,plot=True)
 print(f"Delay estimate = {fix_delay}")
 print(f"Off by: {np.abs(fix_delay)-np.abs(bad_delay)}")
 
@@ -12,7 +12,8 @@ applies the delay correction, and then calculates the estimated visibility^2
 bandpass = 15e-9
 start_wavelength = 600e-9
 end_wavelength = 750e-9
-wavelengths = np.arange(start_wavelength,end_wavelength,bandpass)[:-1] + 0.5*bandpass
+num_channels = int(round((end_wavelength-start_wavelength)/bandpass))
+wavelengths = np.linspace(start_wavelength+0.5*bandpass,end_wavelength-0.5*bandpass,num_channels)
 
 #Throughput (tricoupler with instrumental throughput eta)
 eta = 0.5
@@ -53,7 +54,7 @@ bad_delay = -1.56474575e-5
 gamma = ff.cal_coherence(bad_delay,0,wavelengths,bandpass,(F_0,0,np.pi/5))
 
 #Estimate the visibility based on the corrected coherence and append to list
-vis_bias = np.mean(np.abs(gamma)**2)
+vis_bias = np.mean(ff.abs2(gamma))
 
 #Find complex coherence
 gamma = ff.cal_coherence(bad_delay,0,wavelengths,bandpass,true_params)
@@ -75,4 +76,4 @@ print(f"Off by: {np.abs(fix_delay)-np.abs(bad_delay)}")
 #Adjust the delay and calculate the new coherence.
 #NOTE: MAY NEED TO FIX THIS!!!!
 new_gamma = gamma/np.sinc(fix_delay*bandpass/wavelengths**2)*np.exp(1j*2*np.pi*fix_delay/wavelengths)
-print(f"Visibility^2 estimate = {np.mean(np.abs(new_gamma)**2) - vis_bias}")
+print(f"Visibility^2 estimate = {np.mean(ff.abs2(new_gamma)) - vis_bias}")
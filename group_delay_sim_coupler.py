@@ -17,7 +17,8 @@ n_0 = 1.54
 bandpass = 10e-9
 start_wavelength = 600e-9
 end_wavelength = 750e-9
-wavelengths = np.arange(start_wavelength,end_wavelength,bandpass)[:-1] + 0.5*bandpass
+num_channels = int(round((end_wavelength-start_wavelength)/bandpass))
+wavelengths = np.linspace(start_wavelength+0.5*bandpass,end_wavelength-0.5*bandpass,num_channels)
 
 n = len(wavelengths) #Number of wavelengths
 
@@ -30,7 +31,7 @@ SNR = 100000
 b0 = 1/np.sqrt(2)*np.array([np.ones(n),np.zeros(n),np.exp(1j*2*np.pi/wavelengths*bad_delay)])
 
 #Calculate the intensity at the output of the coupler
-fluxes = np.abs(tri.calc_bz(b0,del_n,n_0))**2
+fluxes = ff.abs2(tri.calc_bz(b0,del_n,n_0))
 
 #Add noise based on the SNR (sigma = intensity/SNR)
 for i in range(3):
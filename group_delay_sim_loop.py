@@ -17,7 +17,8 @@ tracking and science.
 bandpass = 15e-9
 start_wavelength = 600e-9
 end_wavelength = 750e-9
-wavelengths = np.arange(start_wavelength,end_wavelength,bandpass)[:-1] + 0.5*bandpass
+num_channels = int(round((end_wavelength-start_wavelength)/bandpass))
+wavelengths = np.linspace(start_wavelength+0.5*bandpass,end_wavelength-0.5*bandpass,num_channels)
 
 #Throughput (tricoupler with instrumental throughput eta)
 eta = 0.5
@@ -56,14 +57,23 @@ coh_phase = np.pi/6
 vis = 0.5
 true_params = (F_0,vis,coh_phase)
 
+#Calculate the group delay envelope in single precision (faster, but set to
+#False to check results against double precision)
+single_precision = True
+if single_precision:
+    complex_type,real_type = np.complex64,np.float32
+else:
+    complex_type,real_type = complex,float
+
 #List of trial delays to scan
 Num_delays = 200
 scale = 0.1
 wavenumber_bandpass = 1/start_wavelength - 1/end_wavelength
 trial_delays = scale*np.arange(-Num_delays/2+1,Num_delays/2)/wavenumber_bandpass
+#Phasors to rotate the coherence by each trial delay (same for every frame)
+phasors = ff.trial_phasors(trial_delays,wavelengths,complex_type)
 
 fix_delay=0
-vis_array=[]
 
 #Maximum and rms error expected in delay space
 error_rms = 2e-5
@@ -71,60 +81,70 @@ error_rms = 2e-5
 #Number of integrations
 n_iter = 100
 
-#Calc Bias in visibility
-for j in range(n_iter):
-
-    #Generate a random delay based on the error rms
-    #NEED TO CHANGE!!!
-    bad_delay = 2*error_rms*np.random.random_sample() - error_rms
+#Calc Bias in visibility (all n_iter frames at once)
+#Generate random delays based on the error rms
+#NEED TO CHANGE!!!
+bad_delays = ff.rng.uniform(-error_rms,error_rms,n_iter)
 
-    #Calculate the output complex coherence
-    gamma = ff.cal_coherence(bad_delay,0,wavelengths,bandpass,(F_0,0,np.pi/3))
+#Calculate the output complex coherence of each frame
+gammas = ff.cal_coherence_batch(bad_delays,0,wavelengths,bandpass,(F_0,0,np.pi/3))
 
-    #Estimate the visibility based on the corrected coherence and append to list
-    vis_array.append(np.mean(np.abs(gamma)**2))
+#Estimate the visibility of each frame based on the coherence
+vis_array = np.mean(ff.abs2(gammas),axis=1)
 
 #Adopt the median as the true bias
 bias_vis = np.median(vis_array)
 
 #Setup
 vis_array=[]
-ave_delay_envelope = np.zeros(len(trial_delays))
+ave_delay_envelope = np.zeros(len(trial_delays),dtype=real_type)
+gamma = np.zeros(len(wavelengths),dtype=complex_type)
 frame_num = 0
+frame_times = np.empty(n_iter)
+
+#Wavelength dependent parts of the delay correction (same for every frame)
+two_pi_over_lam = 2*np.pi/wavelengths
+sinc_scale = bandpass/wavelengths**2
+
+#Warm up (numba compiles step_frame on its first call) on scratch buffers, so
+#the compile time doesn't end up in the frame times
+ff.step_frame(0.0,0,wavelengths,bandpass,trial_delays,phasors,a,true_params,
+              ave_delay_envelope.copy(),gamma.copy(),ff.rng)
 
 #Simulate a loop of fringe tracking and science
 for j in range(n_iter):
 
-    time_start = time.time()
+    time_start = time.perf_counter()
 
     #Generate a random delay based on the error rms
     #NEED TO CHANGE!!!
-    bad_delay = 2*error_rms*np.random.random_sample() - error_rms
-
-    #Calculate the output complex coherence
-    gamma = ff.cal_coherence(bad_delay,0,wavelengths,bandpass,true_params)
+    bad_delay = ff.rng.uniform(-error_rms,error_rms)
 
-    #Estimate the current delay envelope
-    delay_envelope = ff.group_delay_envelope(gamma,trial_delays,wavelengths)
-
-    #Add to running average
-    ave_delay_envelope = a*delay_envelope + (1-a)*ave_delay_envelope
+    #Calculate the output complex coherence, add the current delay envelope
+    #to the running average and estimate the group delay (all in one kernel)
+    est_delay = ff.step_frame(bad_delay,0,wavelengths,bandpass,trial_delays,
+                              phasors,a,true_params,ave_delay_envelope,gamma,
+                              ff.rng)
 
     #If incoherent integration time is up, find group delay and adjust
     if frame_num < num_group_delay_frames:
-        fix_delay = ff.find_delay(ave_delay_envelope,trial_delays)
+        fix_delay = est_delay
 
         #Adjust the delay and calculate the new coherence????
-        new_gamma = gamma/np.sinc(fix_delay*bandpass/wavelengths**2)*np.exp(-1j*2*np.pi*fix_delay/wavelengths)
+        new_gamma = gamma/ff.sinc_poly(fix_delay*sinc_scale)*np.exp(-1j*two_pi_over_lam*fix_delay)
 
         #Estimate the visibility based on the corrected coherence and append to list
-        vis_array.append(np.mean(np.abs(new_gamma)**2)-bias_vis)
+        vis_array.append(np.mean(ff.abs2(new_gamma))-bias_vis)
 
     frame_num += 1
 
-    #Print time it takes to perform fringe tracking and science
-    time_end = time.time()
-    print(f"Number {j}, Time elapsed = {1000*(time_end-time_start)} ms")
+    #Record time it takes to perform fringe tracking and science
+    frame_times[j] = time.perf_counter() - time_start
+
+#Print the frame times (printed after the loop so it isn't timed)
+print(f"Time per frame: mean = {1000*frame_times.mean()} ms, "
+      f"median = {1000*np.median(frame_times)} ms, "
+      f"std = {1000*frame_times.std()} ms, max = {1000*frame_times.max()} ms")
 
 #Print the average of the estimated visibilities
 print(np.median(vis_array))
@@ -16,7 +16,8 @@ vis = 0.5
 bandpass = 10e-9
 start_wavelength = 600e-9
 end_wavelength = 750e-9
-wavelengths = np.arange(start_wavelength,end_wavelength,bandpass)[:-1] + 0.5*bandpass
+num_channels = int(round((end_wavelength-start_wavelength)/bandpass))
+wavelengths = np.linspace(start_wavelength+0.5*bandpass,end_wavelength-0.5*bandpass,num_channels)
 
 n = len(wavelengths) #Number of wavelengths
 